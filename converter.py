@@ -1,50 +1,67 @@
 import os
 import json
 import csv
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-# Folders
-SOURCE_FOLDER = "/app/source"
-OUTPUT_FOLDER = "/app/out"
+# orjson parses in C; fall back to the standard library when missing
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Folders (relative to the working directory; /app inside the container)
+SOURCE_FOLDER = "./source"
+OUTPUT_FOLDER = "./out"
 OUTPUT_FILE = os.path.join(OUTPUT_FOLDER, "output.csv")
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB output buffer
 
 # Fields to extract
 FIELDS = ["code", "name", "subname", "text", "traits", "flavor", "back_text", "back_flavor"]
 
-def json_to_csv():
-    rows = []
+FILE_CONCURRENCY = 8  # how many JSON files are read at once
+
+# Read one JSON file and return its cards as a list
+def load_items(filepath):
+    filename = os.path.basename(filepath)
+    try:
+        data = json_loads(Path(filepath).read_bytes())
+    except json.JSONDecodeError as e:
+        print(f"⚠️ Skipping {filename}: invalid JSON ({e})")
+        return []
+
+    # JSON can be a dict or list
+    if isinstance(data, dict):
+        return [data]
+    elif isinstance(data, list):
+        return data
+    else:
+        print(f"⚠️ Skipping {filename}: unsupported JSON structure")
+        return []
+
+# Yield one row (values in FIELDS order) per card in /source
+def iter_cards():
+    with os.scandir(SOURCE_FOLDER) as entries:
+        filepaths = [entry.path for entry in entries if entry.is_file() and entry.name.endswith(".json")]
 
+    # Read all JSON files concurrently; map() keeps directory order
+    with ThreadPoolExecutor(max_workers=FILE_CONCURRENCY) as executor:
+        for items in executor.map(load_items, filepaths):
+            for item in items:
+                yield [item.get(field, "") for field in FIELDS]
+
+# Stream rows to a CSV file
+def write_csv(rows, path):
+    with open(path, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+
+def json_to_csv():
     # Make sure /out folder exists
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-    # Iterate over all JSON files in /source
-    for filename in os.listdir(SOURCE_FOLDER):
-        if filename.endswith(".json"):
-            filepath = os.path.join(SOURCE_FOLDER, filename)
-            with open(filepath, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                except json.JSONDecodeError as e:
-                    print(f"⚠️ Skipping {filename}: invalid JSON ({e})")
-                    continue
-
-                # JSON can be a dict or list
-                if isinstance(data, dict):
-                    items = [data]
-                elif isinstance(data, list):
-                    items = data
-                else:
-                    print(f"⚠️ Skipping {filename}: unsupported JSON structure")
-                    continue
-
-                for item in items:
-                    row = {field: item.get(field, "") for field in FIELDS}
-                    rows.append(row)
-
-    # Write to CSV in /out
-    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=FIELDS)
-        writer.writeheader()
-        writer.writerows(rows)
+    write_csv(iter_cards(), OUTPUT_FILE)
 
     print(f"✅ Conversion complete. CSV saved to {OUTPUT_FILE}")
 
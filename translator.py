@@ -1,31 +1,194 @@
 import os
+import re
 import json
 import csv
-import openai
+import sqlite3
+import asyncio
+import argparse
+import httpx
+import tiktoken
+import ahocorasick
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from datetime import datetime, timezone
+from hashlib import blake2b
+from pathlib import Path
 from textwrap import dedent
+from converter import FIELDS, OUTPUT_FOLDER, WRITE_BUFFER_SIZE, iter_cards, write_csv
+from converter import OUTPUT_FILE as INTERMEDIATE_FILE
+
+# orjson parses and serializes in C; fall back to the standard library when missing.
+# Payloads are always compact: whitespace in them is billed as prompt tokens.
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    json_loads = json.loads
 
 # ========= CONFIG =========
-INPUT_FILE = "./out/output.csv"
-OUTPUT_FILE = "./out/output_translated.csv"
+OUTPUT_FILE = os.path.join(OUTPUT_FOLDER, "output_translated.csv")
 GLOSSARY_FOLDER = "./glossary"
+CACHE_FILE = os.path.join(OUTPUT_FOLDER, "cache.sqlite3")
+
+TRANSLATED_FIELDS = FIELDS[1:]  # "code" is copied as-is
+FIELD_INDEX = {field: idx for idx, field in enumerate(FIELDS)}  # column of each field in card rows
+
+MODEL = "gpt-5"  # or gpt-4o-mini if you want cheaper/faster
+
+BATCH_SIZE = 50  # max rows per API call
+MAX_BATCH_TOKENS = 8000  # approximate input tokens per API call
+CONCURRENCY = 20  # how many API calls in flight at once
+RATE_LIMIT = 500  # max API calls started per minute
+MAX_RETRIES = 5  # retries on rate limits, timeouts and connection errors
+MISSING_RETRIES = 3  # resends of entries the model left out of its response, halving the batch each time
+
+# Text made only of icons, {x} tags, glossary placeholders, numbers and punctuation needs no model
+TRIVIAL_RE = re.compile(r"(?:\s|\[\w+\]|\{[^}]*\}|__TERM\d+__|[0-9X\-+.,])+")
+
+
+# SQLite-backed store of finished translations, so reruns only pay for new text
+class Cache:
+    # Kept as a constant so sqlite3's statement cache reuses the compiled plan
+    SET_SQL = "INSERT OR REPLACE INTO cache(key,src,tgt,model,created_at) VALUES(?,?,?,?,?)"
+    GET_MANY_CHUNK = 500  # stays under SQLite's bound-parameter limit
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        # WAL + NORMAL sync: commits append to the log instead of fsyncing the database
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-20000")
+        self.conn.execute("PRAGMA wal_autocheckpoint=1000")
+        # key is cache_key(): 32 hex chars of BLAKE2b-128
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, src TEXT, tgt TEXT, model TEXT, created_at TEXT)"
+        )
+        self.conn.commit()
+        self._pending = []
+
+    # Look up many keys at once, querying SQLite in chunks; each distinct key is fetched once
+    def get_many(self, keys):
+        unique = list(dict.fromkeys(keys))
+        found = {}
+        for i in range(0, len(unique), self.GET_MANY_CHUNK):
+            chunk = unique[i:i + self.GET_MANY_CHUNK]
+            sql = f"SELECT key,tgt FROM cache WHERE key IN ({','.join('?' * len(chunk))})"
+            found.update(self.conn.execute(sql, chunk))
+        return found
+
+    # Writes are buffered until flush(), so callers group them per batch
+    def set(self, key, src, tgt, model):
+        self._pending.append((key, src, tgt, model))
+
+    # Write buffered entries in one transaction, sharing a single timestamp
+    def flush(self):
+        if not self._pending:
+            return
+        created_at = datetime.now(timezone.utc).isoformat()
+        with self.conn:
+            self.conn.executemany(self.SET_SQL, [(*entry, created_at) for entry in self._pending])
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
 
-FIELDS = ["code", "name", "subname", "text", "traits", "flavor", "back_text", "back_flavor"]
 
-BATCH_SIZE = 10  # how many rows per API call (tune based on token size)
+# 128-bit BLAKE2b of model, glossary, field and source text; keys are not adversarial, so speed wins.
+# Cached translations already contain the glossary's terms, so editing the glossary changes every key.
+# Keys from older schemes never match and are simply re-translated.
+def cache_key(field, src, glossary):
+    h = blake2b(digest_size=16)
+    h.update(MODEL.encode("utf-8"))
+    h.update(b"\0")
+    h.update(glossary.fingerprint)
+    h.update(field.encode("utf-8"))
+    h.update(b"\0")
+    h.update(src.encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_automaton(replacements):
+    automaton = ahocorasick.Automaton()
+    for key, value in replacements.items():
+        automaton.add_word(key, (key, value))
+    automaton.make_automaton()
+    return automaton
+
+
+def is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+# Glossary terms with Aho-Corasick automatons built once at load time
+class Glossary:
+    def __init__(self, terms):
+        self.placeholders = {term: info["placeholder"] for term, info in terms.items()}
+        self.translations = {info["placeholder"]: info["translation"] for info in terms.values()}
+        self.term_automaton = build_automaton(self.placeholders) if terms else None
+        self.placeholder_automaton = build_automaton(self.translations) if terms else None
+
+        # Fixed-size digest of the term -> translation pairs, mixed into every cache key
+        h = blake2b(digest_size=16)
+        for term, translation in sorted((term, info["translation"]) for term, info in terms.items()):
+            h.update(term.encode("utf-8"))
+            h.update(b"\0")
+            h.update(translation.encode("utf-8"))
+            h.update(b"\0")
+        self.fingerprint = h.digest()
+
+
+# Replace the longest leftmost non-overlapping matches in one scan of the text
+def replace_matches(text, automaton, whole_words=False):
+    if automaton is None:
+        return text
+
+    matches = []
+    for end, (key, value) in automaton.iter(text):
+        start = end - len(key) + 1
+        stop = end + 1
+        if whole_words and (
+            (start > 0 and is_word_char(text[start - 1]))
+            or (stop < len(text) and is_word_char(text[stop]))
+        ):
+            continue
+        matches.append((start, stop, value))
+    if not matches:
+        return text
+
+    # Longest match first at each start position, so "Clues" wins over "Clue"
+    matches.sort(key=lambda match: (match[0], -match[1]))
+    parts, pos = [], 0
+    for start, stop, value in matches:
+        if start < pos:
+            continue
+        parts.append(text[pos:start])
+        parts.append(value)
+        pos = stop
+    parts.append(text[pos:])
+    return "".join(parts)
 
 
 # Load glossary terms from JSON files in glossary
 def load_glossary():
     glossary = {}
     placeholder_id = 1
-    for filename in os.listdir(GLOSSARY_FOLDER):
-        if filename.endswith(".json"):
-            filepath = os.path.join(GLOSSARY_FOLDER, filename)
-            with open(filepath, "r", encoding="utf-8") as f:
+    with os.scandir(GLOSSARY_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".json"):
                 try:
-                    data = json.load(f)
+                    data = json_loads(Path(entry.path).read_bytes())
                 except json.JSONDecodeError:
-                    print(f"⚠️ Skipping glossary file {filename}: invalid JSON")
+                    print(f"⚠️ Skipping glossary file {entry.name}: invalid JSON")
                     continue
 
                 if isinstance(data, dict):
@@ -33,104 +196,294 @@ def load_glossary():
                         placeholder = f"__TERM{placeholder_id}__"
                         glossary[term] = {"placeholder": placeholder, "translation": translation}
                         placeholder_id += 1
-    return glossary
+    return Glossary(glossary)
+
+
+# Tokenizer used to size batches; newer models may be unknown to tiktoken
+def load_encoding():
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
 
 
 # Replace glossary terms with placeholders
 def apply_placeholders(text, glossary):
-    for term, info in glossary.items():
-        text = text.replace(term, info["placeholder"])
-    return text
+    return replace_matches(text, glossary.term_automaton, whole_words=True)
 
 
 # Restore glossary terms (Portuguese translations)
 def restore_terms(text, glossary):
-    for term, info in glossary.items():
-        text = text.replace(info["placeholder"], info["translation"])
-    return text
-
-
-# Translate a batch of rows at once
-def translate_batch(rows, client, glossary):
-    # Build structured text for translation
-    batch_text = []
-    for idx, row in enumerate(rows):
-        entry_lines = [f"### ENTRY {idx} ###"]
-        for field in FIELDS:
-            value = row[field].strip() if row[field] else ""
-            value = apply_placeholders(value, glossary)
-            entry_lines.append(f"{field}: {value}")
-        batch_text.append("\n".join(entry_lines))
-
-    full_text = "\n\n".join(batch_text)
-
-    prompt = dedent(f"""
+    return replace_matches(text, glossary.placeholder_automaton)
+
+
+# Estimate how many input tokens an entry adds to a batch
+def count_tokens(fields, encoding):
+    return sum(len(encoding.encode(value)) for value in fields.values())
+
+
+# Group (row index, masked fields, source fields) entries into batches capped by BATCH_SIZE and MAX_BATCH_TOKENS
+def chunk_entries(entries, encoding):
+    batch, batch_tokens = [], 0
+    for entry in entries:
+        tokens = count_tokens(entry[1], encoding)
+        if batch and (len(batch) >= BATCH_SIZE or batch_tokens + tokens > MAX_BATCH_TOKENS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(entry)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+# Instructions shared by every call, built once at import. Sending them as an identical
+# system message also lets the API reuse its prompt cache for this prefix.
+SYSTEM_PROMPT = dedent("""
     Você é um tradutor especializado no jogo de cartas "Arkham Horror: The Card Game".
     Traduza o conteúdo a seguir para **português do Brasil**, mantendo a precisão de regras e a naturalidade.
 
     Regras importantes:
     - Preserve marcadores, ícones e símbolos entre colchetes (ex.: [action], [skull]) exatamente como estão.
-    - Não altere tags de formatação ou placeholders ({{{{x}}}}, {{{{n}}}}, etc.).
+    - Não altere tags de formatação ou placeholders ({x}, {n}, __TERM1__, etc.).
     - Mantenha a capitalização de nomes próprios e lugares.
     - Gere traduções **determinísticas**: para o mesmo texto e glossário, o resultado deve ser **exatamente igual**.
     - Evite sinônimos ou variações de estilo; traduza de forma consistente com traduções anteriores.
 
-    Traduza mantendo a mesma estrutura. Não adicione comentários.
-    {full_text}
-    """)
+    A entrada é um objeto JSON {"items": [{"id": 0, "fields": {"name": "...", ...}}, ...]}.
+    Responda com um item para cada "id" da entrada, trocando cada valor de "fields" pela sua tradução.
+    Campos que não vieram na entrada devem ser devolvidos como string vazia. Não adicione comentários.
+""").strip()
+
+# Strict schema for the reply: one item per id, every translatable field present as a string
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "translations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "fields": {
+                                "type": "object",
+                                "properties": {field: {"type": "string"} for field in TRANSLATED_FIELDS},
+                                "required": TRANSLATED_FIELDS,
+                                "additionalProperties": False,
+                            },
+                        },
+                        "required": ["id", "fields"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}
+
 
-    response = client.chat.completions.create(
-        model="gpt-5",  # or gpt-4o-mini if you want cheaper/faster
-        messages=[{"role": "user", "content": prompt}],
+# Translate a batch of {field: text} dicts, already masked with glossary placeholders, at once
+async def translate_batch(entries, client, glossary):
+    # Build a JSON payload with one item per entry
+    items = [{"id": idx, "fields": fields} for idx, fields in enumerate(entries)]
+
+    payload = json_dumps({"items": items})
+
+    response = await client.chat.completions.create(
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": payload},
+        ],
+        response_format=RESPONSE_FORMAT,
         temperature=0
     )
 
-    translated_text = response.choices[0].message["content"].strip()
-
-    # Parse translated response back into rows
-    translated_rows = []
-    current_row = {}
-    for line in translated_text.splitlines():
-        line = line.strip()
-        if line.startswith("### ENTRY"):
-            if current_row:
-                translated_rows.append(current_row)
-            current_row = {}
-        elif ":" in line:
-            field, val = line.split(":", 1)
-            val = restore_terms(val.strip(), glossary)
-            if field in FIELDS:
-                current_row[field] = val
-    if current_row:
-        translated_rows.append(current_row)
-
-    return translated_rows
-
-
-def main():
+    # A truncated, filtered or refused reply costs a resend of the batch, not the whole run
+    choice = response.choices[0]
+    if choice.finish_reason in ("length", "content_filter") or getattr(choice.message, "refusal", None):
+        print(f"⚠️ Unusable response ({choice.finish_reason}); will resend its {len(entries)} entries")
+        return [{} for _ in entries]
+    try:
+        data = json_loads(choice.message.content)
+        translated_by_id = {item["id"]: item.get("fields", {}) for item in data.get("items", [])}
+    except (json.JSONDecodeError, TypeError, AttributeError, KeyError) as e:
+        print(f"⚠️ Malformed response ({e}); will resend its {len(entries)} entries")
+        return [{} for _ in entries]
+
+    # Map answers back in input order; fields the model skipped are left out for the caller to retry
+    results = []
+    for idx, fields in enumerate(entries):
+        answer = translated_by_id.get(idx, {})
+        results.append({
+            field: restore_terms(answer[field], glossary)
+            for field in fields
+            if answer.get(field)
+        })
+
+    return results
+
+
+# Translate all rows into `writer`, reusing cached fields and keeping up to `concurrency` batches in flight
+async def translate_all(rows, writer, client, glossary, cache, encoding, concurrency, rate_limit):
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AsyncLimiter(rate_limit, 60)
+
+    # Look up every non-empty field in the cache with a few batched queries
+    lookups = [
+        (row_idx, field, src, cache_key(field, src, glossary))
+        for row_idx, row in enumerate(rows)
+        for field in TRANSLATED_FIELDS
+        if (src := (row[FIELD_INDEX[field]] or "").strip())
+    ]
+    cached = cache.get_many([key for *_, key in lookups])
+
+    # Fill in cached translations and collect the fields that still need the API
+    translated_rows = [
+        [row[FIELD_INDEX["code"]]] + [""] * len(TRANSLATED_FIELDS)
+        for row in rows
+    ]
+    # Each distinct (field, source) missing from the cache is masked once and sent once, on the
+    # first row that needs it; `waiters` lists every row that gets a copy of its translation
+    missing = {}
+    waiters = {}
+    row_keys = {}
+    for row_idx, field, src, key in lookups:
+        if key in cached:
+            translated_rows[row_idx][FIELD_INDEX[field]] = cached[key]
+            continue
+        if key in waiters:
+            waiters[key].append(row_idx)
+        else:
+            masked = apply_placeholders(src, glossary)
+            if TRIVIAL_RE.fullmatch(masked):
+                cached[key] = restore_terms(masked, glossary)
+                translated_rows[row_idx][FIELD_INDEX[field]] = cached[key]
+                continue
+            waiters[key] = [row_idx]
+            masked_fields, sources = missing.setdefault(row_idx, ({}, {}))
+            masked_fields[field] = masked
+            sources[field] = (src, key)
+        row_keys.setdefault(row_idx, []).append(key)
+    pending = [(row_idx, masked_fields, sources) for row_idx, (masked_fields, sources) in missing.items()]
+
+    async def bounded(batch, attempt=0):
+        async with semaphore, limiter:
+            if attempt:
+                print(f"⚠️ Retrying {len(batch)} entries missing from the response...")
+            else:
+                print(f"🔄 Translating rows {batch[0][0]+1} to {batch[-1][0]+1}...")
+            results = await translate_batch([masked for _, masked, _ in batch], client, glossary)
+
+        # Keep what came back and resend only the fields the model left out
+        leftover = []
+        for (row_idx, masked, sources), result in zip(batch, results):
+            for field, tgt in result.items():
+                src, key = sources[field]
+                for waiting_row in waiters[key]:
+                    translated_rows[waiting_row][FIELD_INDEX[field]] = tgt
+                cache.set(key, src, tgt, MODEL)
+            if len(result) < len(masked):
+                remaining = {field: text for field, text in masked.items() if field not in result}
+                leftover.append((row_idx, remaining, sources))
+        cache.flush()
+
+        if not leftover:
+            return
+        if attempt == MISSING_RETRIES:
+            print(f"⚠️ Gave up on {len(leftover)} entries; their fields are left empty")
+            return
+        # Resend in halves, so a batch whose reply keeps hitting the output limit can still fit
+        half = (len(leftover) + 1) // 2
+        for part in (leftover[:half], leftover[half:]):
+            if part:
+                await bounded(part, attempt + 1)
+
+    # Start every batch, then write rows in order as soon as the batches covering them are done
+    tasks = []
+    task_by_key = {}
+    for batch in chunk_entries(pending, encoding):
+        task = asyncio.ensure_future(bounded(batch))
+        tasks.append(task)
+        for _, _, sources in batch:
+            for _, key in sources.values():
+                task_by_key[key] = task
+
+    writerow = writer.writerow
+    try:
+        for row_idx in range(len(translated_rows)):
+            for key in row_keys.pop(row_idx, ()):
+                await task_by_key[key]
+            writerow(translated_rows[row_idx])
+            translated_rows[row_idx] = None
+    except BaseException:
+        # Stop the other batches and consume their exceptions before propagating the first one
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Translate card JSON to Brazilian Portuguese CSV.")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help=f"max API calls in flight at once (default: {CONCURRENCY})")
+    parser.add_argument("--rate-limit", type=int, default=RATE_LIMIT,
+                        help=f"max API calls started per minute (default: {RATE_LIMIT})")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES,
+                        help=f"retries per API call on transient errors (default: {MAX_RETRIES})")
+    parser.add_argument("--write-intermediate", action="store_true",
+                        help=f"also write the untranslated rows to {INTERMEDIATE_FILE}")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
     glossary = load_glossary()
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    # Read input CSV
-    with open(INPUT_FILE, "r", encoding="utf-8") as infile:
-        reader = csv.DictReader(infile)
-        all_rows = list(reader)
-
-    translated_all = []
-    for i in range(0, len(all_rows), BATCH_SIZE):
-        batch = all_rows[i:i + BATCH_SIZE]
-        print(f"🔄 Translating rows {i+1} to {i+len(batch)}...")
-        translated = translate_batch(batch, client, glossary)
-        translated_all.extend(translated)
-
-    # Save translated CSV
-    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=FIELDS)
-        writer.writeheader()
-        writer.writerows(translated_all)
+    encoding = load_encoding()
+    cache = Cache(CACHE_FILE)
+    # Keep one pooled keep-alive connection per in-flight call; timeouts stay at the SDK default
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+    )
+    # The SDK retries rate limits and connection errors itself, honoring Retry-After
+    client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=http_client,
+        max_retries=args.max_retries,
+    )
+
+    # Read cards straight from the source JSON; the intermediate CSV is only for debugging
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    all_rows = list(iter_cards())
+    if args.write_intermediate:
+        write_csv(all_rows, INTERMEDIATE_FILE)
+
+    # Stream translated rows to a temporary file as they complete; the previous output
+    # is only replaced once every batch has succeeded
+    tmp_file = OUTPUT_FILE + ".tmp"
+    try:
+        with open(tmp_file, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(FIELDS)
+            await translate_all(all_rows, writer, client, glossary, cache, encoding, args.concurrency, args.rate_limit)
+        os.replace(tmp_file, OUTPUT_FILE)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        await client.close()
+        cache.close()
 
     print(f"✅ Translation complete. Saved to {OUTPUT_FILE}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())